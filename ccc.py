@@ -1,20 +1,24 @@
 # /usr/bin/python3
 import argparse
 import errno
+import itertools
+import operator
 import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import FileIO
-from pathlib import Path
 from typing import List, Optional
 
-import requests
-from tabulate import tabulate
-from tqdm import tqdm
+# NOTE: requests, tabulate and tqdm are imported where used, so `--help` doesn't pay their import time
 
 INVALUD_TOKEN_MESSAGE = "Invalid token"
 LIST_ACTION = 'list'
 UPLOAD_ACTION = 'upload'
 DOWNLOAD_ACTION = 'download'
+DEFAULT_PARALLEL_DOWNLOADS = 8
+DOWNLOADABLE_STATUSES = frozenset({'Warning', 'Done'})
 
 
 class DiskFullError(Exception):
@@ -25,9 +29,15 @@ class APIService:
     _CARTIOMATICS_API_URL = 'https://app.cardiomatics.com'
     _SIGNALS_ENDPOINT = '/api/v2/signals'
     _REQUEST_PRINTOUT_ENDPOINT = '/api/v2/signals/{}/report/printout'
-    _PER_PAGE = 50
+    _PER_PAGE = 100
+    _MAX_CONCURRENT_PAGES = 10
     _access_token = None
+    _signals_url = None
+    _printout_url = None
     _api_client = None
+    _dl_client = None
+    _json_loads = None
+    _prefetch_executor = None
 
     class AccessDeniedError(Exception):
         pass
@@ -38,12 +48,41 @@ class APIService:
     class ObjectStorageUploadError(Exception):
         pass
 
-    def __init__(self, access_token: str):
+    def __init__(self, access_token: str, parallel_downloads: int = DEFAULT_PARALLEL_DOWNLOADS):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        try:
+            from orjson import loads as json_loads
+        except ImportError:  # NOTE: orjson is optional, it only speeds up parsing API responses
+            from json import loads as json_loads
+
         self._access_token = access_token
+        self._json_loads = json_loads
+        self._signals_url = self._CARTIOMATICS_API_URL + self._SIGNALS_ENDPOINT
+        self._printout_url = (self._CARTIOMATICS_API_URL + self._REQUEST_PRINTOUT_ENDPOINT).format
+
         self._api_client = requests.Session()
+        # NOTE: pool sized for parallel printouts and page fetches, transient gateway errors are retried with backoff
+        api_pool_size = max(32, parallel_downloads + self._MAX_CONCURRENT_PAGES)
+        self._api_client.mount(
+            'https://',
+            HTTPAdapter(
+                pool_connections=api_pool_size,
+                pool_maxsize=api_pool_size,
+                max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False),
+            ),
+        )
 
         self._api_client.headers['Private-Token'] = self._access_token
 
+        # NOTE: separate session for object storage, so the token isn't leaked to third-party hosts
+        self._dl_client = requests.Session()
+        self._dl_client.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=parallel_downloads))
+
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=self._MAX_CONCURRENT_PAGES)
+
     def _get_signals_page(self, page: int, new: Optional[bool] = None):
         """Requests list signals endpoint
 
@@ -52,20 +91,18 @@ class APIService:
         :raises self.AccessDeniedError:
         :return: tuple (<last_page_index>, <JSON dict>)
         """
-        url = self._CARTIOMATICS_API_URL + self._SIGNALS_ENDPOINT
-
         params = {'page': page, 'per_page': self._PER_PAGE}
         if new:
             params['new'] = new
 
-        response = self._api_client.get(url, params=params)
+        response = self._api_client.get(self._signals_url, params=params)
 
         if response.status_code == 401:
             raise self.AccessDeniedError
 
         elif response.ok:
             last_page = response.headers['x-total-pages']
-            return (int(last_page), response.json())
+            return (int(last_page), self._json_loads(response.content))
 
         else:
             raise NotImplementedError
@@ -79,28 +116,40 @@ class APIService:
         :raises NotImplementedError:
         :return: response dictionary (JSON dict)
         """
-        url = self._CARTIOMATICS_API_URL + self._SIGNALS_ENDPOINT
-
-        response = self._api_client.post(url, json={'name': name, 'file_names_list': [file_name]})
+        response = self._api_client.post(self._signals_url, json={'name': name, 'file_names_list': [file_name]})
 
         if response.status_code == 401:
             raise self.AccessDeniedError
 
         elif response.ok:
-            return response.json()
+            return self._json_loads(response.content)
 
         else:
             raise NotImplementedError
 
     def upload_file_to_object_storage(self, url: str, file: FileIO, post_fields: dict):
-        """Uploads file to object store as multipart/form request
+        """Uploads file to object store as multipart/form request, streamed from disk with a progress bar
 
         :param url: object storage url
         :param file: file object (opened)
         :param post_fields: object storage credentials
         :raises self.ObjectStorageUploadError:
         """
-        response = requests.post(url, files={'file': file}, data=post_fields, stream=True)
+        from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+        from tqdm import tqdm
+
+        file_name = os.path.basename(file.name)
+        # NOTE: same fields as data=/files= would send: values stringified, None skipped, file part last,
+        # as object storage ignores fields sent after it
+        fields = [(key, str(value)) for key, value in post_fields.items() if value is not None]
+        fields.append(('file', (file_name, file, 'application/octet-stream')))
+        encoder = MultipartEncoder(fields=fields)
+
+        with tqdm(desc=file_name, total=encoder.len, unit='iB', unit_scale=True, unit_divisor=1024) as bar:
+            monitor = MultipartEncoderMonitor(encoder, lambda monitor: bar.update(monitor.bytes_read - bar.n))
+            response = self._dl_client.post(
+                url, data=monitor, headers={'Content-Type': monitor.content_type}, stream=True
+            )
 
         if not response.ok:
             raise self.ObjectStorageUploadError
@@ -108,22 +157,37 @@ class APIService:
         return response
 
     def get_list_signals_batches(self, new: Optional[bool] = None):
-        """Direct pagination iterator over get signals endpoint
+        """Direct pagination iterator over get signals endpoint, fetches all known pages concurrently
 
         :param new: filtering by new signals, defaults to None
         :yield: List of signals (JSON)
         """
 
         current_page = 1
+        requested_page = 1
+        pending_pages = deque()
+        last_page, data = self._get_signals_page(current_page, new=new)
 
-        while True:
-            last_page, data = self._get_signals_page(current_page, new=new)
-            yield data
+        try:
+            while True:
+                # NOTE: every page known so far is requested in the background, pages are yielded in order
+                while requested_page < last_page:
+                    requested_page += 1
+                    pending_pages.append(
+                        self._prefetch_executor.submit(self._get_signals_page, requested_page, new=new)
+                    )
 
-            if current_page >= last_page:
-                break
+                yield data
 
-            current_page += 1
+                if current_page >= last_page:
+                    break
+
+                current_page += 1
+                last_page, data = pending_pages.popleft().result()
+
+        finally:
+            for pending_page in pending_pages:
+                pending_page.cancel()
 
     def request_printout(self, signal_id: int):
         """Requests printout for given signal_id
@@ -134,8 +198,7 @@ class APIService:
         :raises NotImplementedError:
         :return: printout response: dict (JSON)
         """
-        url = self._CARTIOMATICS_API_URL + self._REQUEST_PRINTOUT_ENDPOINT.format(signal_id)
-        response = self._api_client.get(url)
+        response = self._api_client.get(self._printout_url(signal_id))
 
         if response.status_code == 401:
             raise self.AccessDeniedError
@@ -144,7 +207,7 @@ class APIService:
             raise self.NotVisitedBeforeViaPortalError
 
         elif response.ok:
-            return response.json()
+            return self._json_loads(response.content)
 
         else:
             raise NotImplementedError
@@ -156,7 +219,8 @@ class APIService:
         :raises NotImplementedError:
         :return: requests.Response
         """
-        response = requests.get(url, stream=True)
+        # NOTE: reports are already compressed, asking for them gzipped only costs CPU on both ends
+        response = self._dl_client.get(url, headers={'Accept-Encoding': 'identity'}, stream=True)
 
         if response.ok:
             return response
@@ -168,15 +232,14 @@ class APIService:
 class PrintService:
     """Handles printing signals to console"""
 
+    _SIGNAL_COLUMNS = operator.itemgetter('id', 'created_at', 'status', 'new')
+    _SIGNALS_TABLE_HEADERS = ("ID", "Name", "Created at", "Status", "New")
+    _SIGNALS_TABLE_FORMAT = None
+
     @classmethod
     def signals_object_to_column(cls, signal: dict):
-        return [
-            signal.get('id'),
-            signal.get('physician').get('name'),
-            signal.get('created_at'),
-            signal.get('status'),
-            signal.get('new'),
-        ]
+        signal_id, created_at, status, new = cls._SIGNAL_COLUMNS(signal)
+        return [signal_id, signal['physician']['name'], created_at, status, new]
 
     @classmethod
     def print_signals(cls, signals: List[dict]):
@@ -184,13 +247,28 @@ class PrintService:
 
         :param signals: signals dict
         """
-        columned_data_list = [cls.signals_object_to_column(signal) for signal in signals]
+        from tabulate import DataRow, Line, TableFormat, tabulate
+
+        if cls._SIGNALS_TABLE_FORMAT is None:
+            # NOTE: same layout as tabulate's "simple" format, passed as an object to skip format name lookup
+            cls._SIGNALS_TABLE_FORMAT = TableFormat(
+                lineabove=Line('', '-', '  ', ''),
+                linebelowheader=Line('', '-', '  ', ''),
+                linebetweenrows=None,
+                linebelow=Line('', '-', '  ', ''),
+                headerrow=DataRow('', '  ', ''),
+                datarow=DataRow('', '  ', ''),
+                padding=0,
+                with_header_hide=['lineabove', 'linebelow'],
+            )
+
+        columned_data_list = list(map(cls.signals_object_to_column, signals))
 
         print(
             tabulate(
                 columned_data_list,
-                headers=["ID", "Name", "Created at", "Status", "New"],
-                tablefmt="signals-table",
+                headers=cls._SIGNALS_TABLE_HEADERS,
+                tablefmt=cls._SIGNALS_TABLE_FORMAT,
                 showindex=False,
             )
         )
@@ -202,20 +280,34 @@ def get_list_signals_batches_auth_handled(api_service: APIService, new: Optional
     :param new: filtering by new signals, defaults to None
     :yield: List of signals (JSON)
     """
-    iterator = iter(api_service.get_list_signals_batches(new=new))
+    try:
+        yield from api_service.get_list_signals_batches(new=new)
 
-    while True:
-        try:
-            signals_batch = next(iterator)
+    except APIService.AccessDeniedError:
+        print(INVALUD_TOKEN_MESSAGE)
+        raise SystemExit(1)
 
-        except APIService.AccessDeniedError:
-            print(INVALUD_TOKEN_MESSAGE)
-            exit(1)
 
-        except StopIteration:
-            break
+def preallocate_file(file: FileIO, size: int):
+    """Reserves disk space for a file that is about to be written sequentially, where the OS supports it
 
-        yield signals_batch
+    :param file: file object (opened for writing)
+    :param size: expected file size in bytes
+    :raises OSError: when there is no space left on the device
+    """
+    fd = file.fileno()
+
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # NOTE: not every filesystem supports preallocation, plain writes still work
+
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
 
 
 def download_file_with_progress_bar(api_service: APIService, url: str, dir_path: str, file_name: str):
@@ -227,7 +319,10 @@ def download_file_with_progress_bar(api_service: APIService, url: str, dir_path:
     :param file_name: destination file name
     :raises DiskFullError: when disk is full
     """
-    CHUNK_SIZE = 1024
+    from tqdm import tqdm
+    from tqdm.utils import CallbackIOWrapper
+
+    CHUNK_SIZE = 256 * 1024
     download_dest = os.path.join(dir_path, file_name)
 
     try:
@@ -240,9 +335,19 @@ def download_file_with_progress_bar(api_service: APIService, url: str, dir_path:
                 unit_scale=True,
                 unit_divisor=1024,
             ) as bar:
-                for data in response.iter_content(chunk_size=CHUNK_SIZE):
-                    size = file.write(data)
-                    bar.update(size)
+                # NOTE: decode only if storage ignored Accept-Encoding: identity and encoded the body anyway
+                response.raw.decode_content = 'content-encoding' in response.headers
+
+                try:
+                    if total and not response.raw.decode_content:
+                        preallocate_file(file, total)
+
+                    # NOTE: progress bar is updated on every write, the copy loop itself runs in shutil
+                    shutil.copyfileobj(response.raw, CallbackIOWrapper(bar.update, file, 'write'), CHUNK_SIZE)
+
+                finally:
+                    # NOTE: drops preallocated space past the last write, so failed downloads don't look complete
+                    file.truncate()
 
     except OSError as e:
         if e.errno == errno.ENOSPC:
@@ -265,13 +370,31 @@ def create_parser():
             return path
         else:
             print('Not a directory')
-            exit(1)
+            raise SystemExit(1)
+
+    def positive_int(value):
+        """Positive integer validator
+
+        :param value: integer string ex. 8
+        :return: int if value is positive
+        """
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+
+        if number > 0:
+            return number
+        else:
+            print('Not a positive integer')
+            raise SystemExit(1)
 
     ACCESS_TOKEN_ARGUMENT = '--access-token'
     FILE_PATH_ARGUMENT = '--file-path'
     NAME_ARGUMENT = '--name'
     DIR_PATH_ARGUMENT = '--dir-path'
     NEW_ARGUMENT = '--new'
+    PARALLEL_ARGUMENT = '--parallel'
 
     parser = argparse.ArgumentParser(description='Cardiomatics Console Client')
     subparsers = parser.add_subparsers(dest='action', title='Available actions', required=True)
@@ -292,6 +415,12 @@ def create_parser():
     download_parser.add_argument(
         NEW_ARGUMENT, action='store_true', help='Filtering by only new signals', default=False
     )
+    download_parser.add_argument(
+        PARALLEL_ARGUMENT,
+        type=positive_int,
+        help='Number of reports downloaded in parallel',
+        default=DEFAULT_PARALLEL_DOWNLOADS,
+    )
 
     return parser
 
@@ -302,13 +431,7 @@ def handle_list(args: argparse.Namespace):
     :param args: argparse arguments, required: access_token:str
     """
     api_service = APIService(args.access_token)
-    signals = []
-
-    signal_batches_iterator = iter(get_list_signals_batches_auth_handled(api_service))
-
-    for signals_batch in signal_batches_iterator:
-        for signal in signals_batch:
-            signals.append(signal)
+    signals = list(itertools.chain.from_iterable(get_list_signals_batches_auth_handled(api_service)))
 
     print('\nList of signals:')
     PrintService.print_signals(signals)
@@ -329,7 +452,7 @@ def handle_upload(args: argparse.Namespace):
 
     except api_service.AccessDeniedError:
         print(INVALUD_TOKEN_MESSAGE)
-        exit(1)
+        raise SystemExit(1)
 
     post_fields = response_dict.get('files')[0].get('post_fields')
     object_storage_url = response_dict.get('files')[0].get('url')
@@ -340,7 +463,7 @@ def handle_upload(args: argparse.Namespace):
 
     except api_service.ObjectStorageUploadError:
         print('Object store error')
-        exit(1)
+        raise SystemExit(1)
 
     print('Upload successful!')
 
@@ -352,54 +475,81 @@ def get_local_filename(base_file_name: str):
     :param base_file_name: server file name
     :return: download file name
     """
-    file_without_extension = Path(base_file_name).stem
-    file_extension = Path(base_file_name).suffix
+    file_without_extension, file_extension = os.path.splitext(os.path.basename(base_file_name))
     now = datetime.now().isoformat()
     return f'{file_without_extension}-{now}{file_extension}'
 
 
+def download_signal_report(api_service: APIService, signal: dict, dir_path: str):
+    """Requests printout for given signal and downloads it
+
+    :param api_service: APIService instance
+    :param signal: signal dict
+    :param dir_path: download directory
+    :raises APIService.AccessDeniedError:
+    :raises APIService.NotVisitedBeforeViaPortalError:
+    :raises DiskFullError: when disk is full
+    """
+    response = api_service.request_printout(signal.get('id'))
+
+    url = response.get('url')
+    file_name = response.get('name')
+    local_file_name = get_local_filename(file_name)
+
+    download_file_with_progress_bar(api_service, url, dir_path, local_file_name)
+
+
 def handle_download(args: argparse.Namespace):
     """Download action main handler
 
-    :param args: argparse arguments. required: access_token:str, new:bool, dir_path:str
+    :param args: argparse arguments. required: access_token:str, new:bool, dir_path:str, parallel:int
     """
-    api_service = APIService(args.access_token)
-
-    signal_batches_iterator = iter(get_list_signals_batches_auth_handled(api_service, new=args.new))
+    api_service = APIService(args.access_token, parallel_downloads=args.parallel)
 
     downloaded_reports = []
     not_downloaded_reports = []
 
-    for signals_batch in signal_batches_iterator:
-        for signal in signals_batch:
-            status = signal.get('status')
-            if status not in ['Warning', 'Done']:
-                not_downloaded_reports.append(signal)
-                continue
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        try:
+            jobs = []  # NOTE: (signal, future) pairs, future is None for signals not ready to download
+
+            for signals_batch in get_list_signals_batches_auth_handled(api_service, new=args.new):
+                for signal in signals_batch:
+                    status = signal.get('status')
+                    if status not in DOWNLOADABLE_STATUSES:
+                        jobs.append((signal, None))
+                        continue
 
-            try:
-                response = api_service.request_printout(signal.get('id'))
+                    jobs.append((signal, executor.submit(download_signal_report, api_service, signal, args.dir_path)))
 
-            except APIService.NotVisitedBeforeViaPortalError:
-                not_downloaded_reports.append(signal)
-                print('Not visited by app before')
-                continue
+            # NOTE: results are collected in submission order, so reports are listed in API order
+            for signal, job in jobs:
+                if job is None:
+                    not_downloaded_reports.append(signal)
+                    continue
 
-            except APIService.AccessDeniedError:
-                print(INVALUD_TOKEN_MESSAGE)
-                exit(1)
+                try:
+                    job.result()
 
-            url = response.get('url')
-            file_name = response.get('name')
-            local_file_name = get_local_filename(file_name)
+                except APIService.NotVisitedBeforeViaPortalError:
+                    not_downloaded_reports.append(signal)
+                    print('Not visited by app before')
+                    continue
 
-            try:
-                download_file_with_progress_bar(api_service, url, args.dir_path, local_file_name)
+                except APIService.AccessDeniedError:
+                    print(INVALUD_TOKEN_MESSAGE)
+                    raise SystemExit(1)
 
-            except DiskFullError:
-                print("Disk full, can't download")
-                exit(1)
-            downloaded_reports.append(signal)
+                except DiskFullError:
+                    print("Disk full, can't download")
+                    raise SystemExit(1)
+
+                downloaded_reports.append(signal)
+
+        except BaseException:
+            # NOTE: don't let the executor wait for queued downloads on errors or Ctrl+C
+            executor.shutdown(cancel_futures=True)
+            raise
 
     if downloaded_reports:
         print(f'\nDownloaded signal reports: {len(downloaded_reports)}')
@@ -409,7 +559,7 @@ def handle_download(args: argparse.Namespace):
         print('\nNot downloaded reports (due error)')
         PrintService.print_signals(not_downloaded_reports)
 
-    if not (downloaded_reports + not_downloaded_reports):
+    if not downloaded_reports and not not_downloaded_reports:
         print('\nNo signals available')
 
 
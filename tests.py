@@ -1,52 +1,110 @@
 import argparse
+import errno
+import gzip
+import os
+import time
 import unittest
-from io import BytesIO, StringIO
-from unittest.mock import ANY, patch
+from datetime import datetime
+from io import BytesIO
+from types import MappingProxyType, SimpleNamespace
+from unittest.mock import ANY, Mock, call
 
 import pytest
 import requests_mock
-from freezegun import freeze_time
+from urllib3.exceptions import ProtocolError
+
+from ccc import (
+    APIService,
+    DiskFullError,
+    PrintService,
+    download_file_with_progress_bar,
+    get_local_filename,
+    handle_download,
+    handle_list,
+    handle_upload,
+    preallocate_file,
+)
+
+
+def read_only_signal(signal):
+    """Wraps signal dict, including the nested physician dict, so shared fixtures can't be mutated"""
+    return MappingProxyType({**signal, "physician": MappingProxyType(signal["physician"])})
+
+
+@pytest.fixture(scope='module')
+def signal_done():
+    return read_only_signal(
+        {"id": 1, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": False}
+    )
+
+
+@pytest.fixture(scope='module')
+def signal_new():
+    return read_only_signal(
+        {"id": 2, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": True}
+    )
+
 
-from ccc import APIService, PrintService, get_local_filename, handle_download, handle_list, handle_upload
+@pytest.fixture(scope='module')
+def signals_two():
+    return (
+        read_only_signal(
+            {"id": 1, "physician": {"name": "Dr. Smithson"}, "created_at": "2023-07-29", "status": "Done", "new": False}
+        ),
+        read_only_signal(
+            {"id": 2, "physician": {"name": "Dr. Johnson"}, "created_at": "2023-07-23", "status": "Done", "new": True}
+        ),
+    )
+
+
+@pytest.fixture
+def api_stubs(monkeypatch):
+    """Replaces APIService requests and report downloads with plain mocks"""
+    stubs = SimpleNamespace(
+        get_list_signals_batches=Mock(),
+        create_new_signal=Mock(),
+        upload_file_to_object_storage=Mock(),
+        request_printout=Mock(),
+        download_file_with_progress_bar=Mock(),
+    )
+
+    for name in ('get_list_signals_batches', 'create_new_signal', 'upload_file_to_object_storage', 'request_printout'):
+        monkeypatch.setattr(APIService, name, getattr(stubs, name))
+
+    monkeypatch.setattr('ccc.download_file_with_progress_bar', stubs.download_file_with_progress_bar)
+
+    return stubs
 
 
 class TestListCLIHandler:
-    @patch('ccc.APIService.get_list_signals_batches')
-    @patch('ccc.PrintService.print_signals')
-    def test_list_handler(self, print_signals, get_list_signals_batches):
-        signals_data = [
-            {"id": 1, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": False},
-        ]
-        get_list_signals_batches.return_value = [signals_data]
+    def test_list_handler(self, api_stubs, monkeypatch, signal_done):
+        print_signals = Mock()
+        monkeypatch.setattr(PrintService, 'print_signals', print_signals)
+
+        signals_data = [signal_done]
+        api_stubs.get_list_signals_batches.return_value = [signals_data]
 
         args = argparse.Namespace(access_token='ACCESS_TOKEN')
 
         handle_list(args)
 
-        get_list_signals_batches.assert_called_once_with(new=None)
+        api_stubs.get_list_signals_batches.assert_called_once_with(new=None)
 
         print_signals.assert_called_once_with(signals_data)
 
-    def test_print_signals(self):
-        signals_data = [
-            {
-                "id": 1,
-                "physician": {"name": "Dr. Smithson"},
-                "created_at": "2023-07-29",
-                "status": "Done",
-                "new": False,
-            },
-            {
-                "id": 2,
-                "physician": {"name": "Dr. Johnson"},
-                "created_at": "2023-07-23",
-                "status": "Done",
-                "new": True,
-            },
-        ]
-        with patch('sys.stdout', new=StringIO()) as fake_out:
-            PrintService.print_signals(signals_data)
-            printed = fake_out.getvalue()
+    def test_list_handler_invalid_token(self, api_stubs):
+        api_stubs.get_list_signals_batches.side_effect = APIService.AccessDeniedError
+
+        args = argparse.Namespace(access_token='INVALID_TOKEN')
+
+        with pytest.raises(SystemExit) as exc_info:
+            handle_list(args)
+
+        assert exc_info.value.code == 1
+
+    def test_print_signals(self, signals_two, capsys):
+        PrintService.print_signals(signals_two)
+        printed = capsys.readouterr().out
 
         assert printed == (
             '  ID  Name          Created at    Status    New\n'
@@ -63,10 +121,8 @@ class MockFileObject(BytesIO):
 
 
 class TestUploadCLIHandler:
-    @patch('ccc.APIService.create_new_signal')
-    @patch('ccc.APIService.upload_file_to_object_storage')
-    def test_upload_handler(self, upload_to_object_storage, create_new_signal):
-        create_new_signal.return_value = {
+    def test_upload_handler(self, api_stubs):
+        api_stubs.create_new_signal.return_value = {
             "files": [
                 {"post_fields": {"file": "file_data", "file_name": "test_signal.pdf"}, "url": "https://example.com"}
             ]
@@ -78,203 +134,402 @@ class TestUploadCLIHandler:
 
         handle_upload(args)
 
-        create_new_signal.assert_called_once_with("name", "signal_file.pdf")
+        api_stubs.create_new_signal.assert_called_once_with("name", "signal_file.pdf")
 
-        upload_to_object_storage.assert_called_once_with(
+        api_stubs.upload_file_to_object_storage.assert_called_once_with(
             "https://example.com", signal_file, {"file": "file_data", "file_name": "test_signal.pdf"}
         )
 
 
 class TestDownloadCLIHandler:
-    @patch('ccc.APIService.get_list_signals_batches')
-    @patch('ccc.APIService.request_printout')
-    @patch('ccc.download_file_with_progress_bar')
-    def test_download_handler(
-        self,
-        download_file_with_progress_bar,
-        request_printout,
-        get_list_signals_batches,
-    ):
-        get_list_signals_batches.return_value = [
-            [
-                {
-                    "id": 1,
-                    "physician": {"name": "Dr. Smith"},
-                    "created_at": "2023-07-29",
-                    "status": "Done",
-                    "new": False,
-                },
-            ]
-        ]  # NOTE: list of lists
+    def test_download_handler(self, api_stubs, signal_done):
+        api_stubs.get_list_signals_batches.return_value = [[signal_done]]  # NOTE: list of lists
 
-        request_printout.return_value = {"url": "https://example.com", "name": "test_signal.pdf"}
+        api_stubs.request_printout.return_value = {"url": "https://example.com", "name": "test_signal.pdf"}
 
-        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=False)
+        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=False, parallel=8)
 
         handle_download(args)
 
-        get_list_signals_batches.assert_called_once_with(new=False)
-
-        request_printout.assert_called_once_with(1)
-
-        download_file_with_progress_bar.assert_called_once_with(ANY, "https://example.com", '/my/path', ANY)
-
-    @patch('ccc.APIService.get_list_signals_batches')
-    @patch('ccc.APIService.request_printout')
-    @patch('ccc.download_file_with_progress_bar')
-    def test_download_handler_downloads_only_new_signals(
-        self,
-        download_file_with_progress_bar,
-        request_printout,
-        get_list_signals_batches,
-    ):
-        get_list_signals_batches.return_value = [
-            [
-                {
-                    "id": 2,
-                    "physician": {"name": "Dr. Smith"},
-                    "created_at": "2023-07-29",
-                    "status": "Done",
-                    "new": True,
-                },
-            ]
+        api_stubs.get_list_signals_batches.assert_called_once_with(new=False)
+
+        api_stubs.request_printout.assert_called_once_with(1)
+
+        api_stubs.download_file_with_progress_bar.assert_called_once_with(ANY, "https://example.com", '/my/path', ANY)
+
+    def test_download_handler_downloads_only_new_signals(self, api_stubs, signal_new):
+        api_stubs.get_list_signals_batches.return_value = [[signal_new]]
+
+        api_stubs.request_printout.return_value = {"url": "https://example.com", "name": "test_signal.pdf"}
+
+        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=True, parallel=8)
+
+        handle_download(args)
+
+        api_stubs.get_list_signals_batches.assert_called_once_with(new=True)
+
+        api_stubs.download_file_with_progress_bar.assert_called_once_with(ANY, "https://example.com", '/my/path', ANY)
+
+    def test_download_handler_keeps_signals_order(self, api_stubs, monkeypatch):
+        print_signals = Mock()
+        monkeypatch.setattr(PrintService, 'print_signals', print_signals)
+
+        signals_data = [
+            {"id": 1, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": False},
+            {"id": 2, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "New", "new": False},
+            {"id": 3, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": False},
+            {
+                "id": 4,
+                "physician": {"name": "Dr. Smith"},
+                "created_at": "2023-07-29",
+                "status": "Warning",
+                "new": False,
+            },
         ]
+        api_stubs.get_list_signals_batches.return_value = [signals_data[:2], signals_data[2:]]
 
-        request_printout.return_value = {"url": "https://example.com", "name": "test_signal.pdf"}
+        def request_printout_side_effect(signal_id):
+            if signal_id == 3:
+                raise APIService.NotVisitedBeforeViaPortalError
+            return {"url": "https://example.com", "name": "test_signal.pdf"}
 
-        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=True)
+        api_stubs.request_printout.side_effect = request_printout_side_effect
+
+        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=False, parallel=4)
 
         handle_download(args)
 
-        get_list_signals_batches.assert_called_once_with(new=True)
+        assert api_stubs.download_file_with_progress_bar.call_count == 2
+        assert print_signals.call_args_list == [
+            call([signals_data[0], signals_data[3]]),
+            call([signals_data[1], signals_data[2]]),
+        ]
+
+    def test_download_handler_cancels_queued_downloads_on_error(self, api_stubs):
+        signals_data = [
+            {"id": i, "physician": {"name": "Dr. Smith"}, "created_at": "2023-07-29", "status": "Done", "new": False}
+            for i in range(1, 21)
+        ]
+        api_stubs.get_list_signals_batches.return_value = [signals_data]
+
+        def request_printout_side_effect(signal_id):
+            if signal_id == 1:
+                raise NotImplementedError
+            return {"url": "https://example.com", "name": "test_signal.pdf"}
 
-        download_file_with_progress_bar.assert_called_once_with(ANY, "https://example.com", '/my/path', ANY)
+        api_stubs.request_printout.side_effect = request_printout_side_effect
+        api_stubs.download_file_with_progress_bar.side_effect = lambda *args: time.sleep(0.05)
 
-    @freeze_time('2023-01-01T00:00:00')
-    def test_get_local_filename(self):
-        assert get_local_filename('test.pdf') == 'test-2023-01-01T00:00:00.pdf'
+        args = argparse.Namespace(access_token='ACCESS_TOKEN', dir_path='/my/path', new=False, parallel=2)
 
+        with pytest.raises(NotImplementedError):
+            handle_download(args)
 
-class TestAPIService:
-    def setup_method(self, method):
-        self.access_token = "ACCESS_TOKEN"
-        self.api_service = APIService(self.access_token)
+        assert api_stubs.download_file_with_progress_bar.call_count < len(signals_data) - 1
 
-    def test_create_new_signal_success(self):
-        expected_response = {'signal_id': '123'}
+    def test_get_local_filename(self, monkeypatch):
+        monkeypatch.setattr('ccc.datetime', SimpleNamespace(now=lambda: datetime(2023, 1, 1)))
+
+        assert get_local_filename('test.pdf') == 'test-2023-01-01T00:00:00.pdf'
+
+
+class TestDownloadFileWithProgressBar:
+    def test_download_file_with_progress_bar(self, tmp_path):
+        api_service = APIService('ACCESS_TOKEN')
+        content = b'pdf content' * 100000
 
         with requests_mock.Mocker() as m:
-            m.post('https://app.cardiomatics.com/api/v2/signals', status_code=201, json=expected_response)
+            m.get('https://example.com/test_signal.pdf', content=content, headers={'content-length': str(len(content))})
 
-            response = self.api_service.create_new_signal('name', 'example.txt')
+            download_file_with_progress_bar(
+                api_service, 'https://example.com/test_signal.pdf', str(tmp_path), 'test_signal.pdf'
+            )
 
-            assert m.last_request.headers['Private-Token'] == self.access_token
-            assert response == expected_response
+        assert (tmp_path / 'test_signal.pdf').read_bytes() == content
+
+    def test_download_file_with_progress_bar_decodes_encoded_body(self, tmp_path):
+        api_service = APIService('ACCESS_TOKEN')
+        content = b'pdf content' * 100000
 
-    def test_create_new_signal_failure(self):
         with requests_mock.Mocker() as m:
-            m.post(
-                'https://app.cardiomatics.com/api/v2/signals',
-                status_code=401,
-                json={"detail": "Incorrect authentication credentials.", "status_code": 401},
+            m.get(
+                'https://example.com/test_signal.pdf',
+                content=gzip.compress(content),
+                headers={"content-encoding": "gzip"},
+            )
+
+            download_file_with_progress_bar(
+                api_service, 'https://example.com/test_signal.pdf', str(tmp_path), 'test_signal.pdf'
             )
 
-            with pytest.raises(APIService.AccessDeniedError):
-                self.api_service.create_new_signal('name', 'example.txt')
+        assert (tmp_path / 'test_signal.pdf').read_bytes() == content
 
-            assert m.last_request.headers['Private-Token'] == self.access_token
 
-    def test_request_printout_success(self):
+    def test_download_file_with_progress_bar_truncates_partial_download(self, tmp_path):
+        api_service = APIService('ACCESS_TOKEN')
+
+        class ResetAfterBytes(BytesIO):
+            """Body that drops the connection after the first 2000 bytes"""
+
+            def read(self, size=-1):
+                if self.tell() >= 2000:
+                    raise ConnectionResetError(errno.ECONNRESET, 'Connection reset by peer')
+                return super().read(2000 - self.tell())
+
         with requests_mock.Mocker() as m:
             m.get(
-                'https://app.cardiomatics.com/api/v2/signals/123/report/printout',
-                status_code=200,
-                json={'test': 'test'},
+                'https://example.com/test_signal.pdf',
+                body=ResetAfterBytes(b'x' * 1000000),
+                headers={'content-length': '1000000'},
             )
 
-            response = self.api_service.request_printout(123)
+            with pytest.raises(ProtocolError):
+                download_file_with_progress_bar(
+                    api_service, 'https://example.com/test_signal.pdf', str(tmp_path), 'test_signal.pdf'
+                )
+
+        assert (tmp_path / 'test_signal.pdf').read_bytes() == b'x' * 2000
 
-            assert m.last_request.headers['Private-Token'] == self.access_token
+    def test_download_file_with_progress_bar_disk_full_on_preallocation(self, tmp_path, monkeypatch):
+        def posix_fallocate(fd, offset, size):
+            raise OSError(errno.ENOSPC, 'No space left on device')
 
-            assert response == {'test': 'test'}
+        monkeypatch.setattr(os, 'posix_fallocate', posix_fallocate, raising=False)
+        api_service = APIService('ACCESS_TOKEN')
+
+        with requests_mock.Mocker() as m:
+            m.get('https://example.com/test_signal.pdf', content=b'pdf', headers={'content-length': '3'})
+
+            with pytest.raises(DiskFullError):
+                download_file_with_progress_bar(
+                    api_service, 'https://example.com/test_signal.pdf', str(tmp_path), 'test_signal.pdf'
+                )
+
+        assert (tmp_path / 'test_signal.pdf').read_bytes() == b''
+
+
+class TestPreallocateFile:
+    @pytest.mark.skipif(not hasattr(os, 'posix_fallocate'), reason='posix_fallocate not available')
+    def test_preallocate_file(self, tmp_path):
+        with open(tmp_path / 'test_signal.pdf', 'wb') as file:
+            preallocate_file(file, 4096)
+
+            assert os.fstat(file.fileno()).st_size == 4096
+
+    def test_preallocate_file_ignores_unsupported_filesystem(self, tmp_path, monkeypatch):
+        def posix_fallocate(fd, offset, size):
+            raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+        monkeypatch.setattr(os, 'posix_fallocate', posix_fallocate, raising=False)
+
+        with open(tmp_path / 'test_signal.pdf', 'wb') as file:
+            preallocate_file(file, 4096)
+
+            assert os.fstat(file.fileno()).st_size == 0
+
+
+class TestAPIService:
+    access_token = "ACCESS_TOKEN"
+    signals_url = 'https://app.cardiomatics.com/api/v2/signals'
+    printout_url = 'https://app.cardiomatics.com/api/v2/signals/123/report/printout'
+    storage_url = 'https://storage.example.com'
+
+    @pytest.fixture(scope='class')
+    def api_service(self):
+        return APIService(self.access_token)
+
+    @pytest.fixture(scope='class')
+    def class_http_mocker(self):
+        with requests_mock.Mocker() as m:
+            yield m
+
+    @pytest.fixture
+    def http_mocker(self, class_http_mocker):
+        """Class-wide mocker with success responses registered, failure tests override single endpoints"""
+        m = class_http_mocker
+        # NOTE: newest registration wins, so re-registering undoes overrides left by the previous test
+        m.post(self.signals_url, status_code=201, json={'signal_id': '123'})
+        m.get(f'{self.signals_url}?page=1', status_code=200, headers={'x-total-pages': '2'}, json=[{'id': 1}])
+        m.get(f'{self.signals_url}?page=2', status_code=200, headers={'x-total-pages': '3'}, json=[{'id': 2}])
+        m.get(f'{self.signals_url}?page=3', status_code=200, headers={'x-total-pages': '3'}, json=[{'id': 3}])
+        m.get(self.printout_url, status_code=200, json={'test': 'test'})
+        m.post(self.storage_url, status_code=204)
+        m.get(f'{self.storage_url}/test_signal.pdf', status_code=200, content=b'pdf')
+        m.reset_mock()
+        return m
+
+    @pytest.fixture
+    def create_new_signal_mocker(self, http_mocker, request):
+        """http_mocker with create signal endpoint failing with status code given as param"""
+        http_mocker.post(self.signals_url, status_code=request.param, json={"status_code": request.param})
+        return http_mocker
+
+    @pytest.fixture
+    def printout_mocker(self, http_mocker, request):
+        """http_mocker with printout endpoint failing with status code given as param"""
+        http_mocker.get(self.printout_url, status_code=request.param, json={'test': 'test'})
+        return http_mocker
+
+    @pytest.fixture
+    def signals_page_mocker(self, http_mocker, request):
+        """http_mocker with first signals page failing with status code given as param"""
+        http_mocker.get(f'{self.signals_url}?page=1', status_code=request.param)
+        return http_mocker
+
+    def test_api_client_retries_gateway_errors(self, api_service):
+        retries = api_service._api_client.get_adapter('https://app.cardiomatics.com').max_retries
+
+        assert retries.total == 5
+        assert set(retries.status_forcelist) == {502, 503, 504}
+        assert 'GET' in retries.allowed_methods
+        assert 'POST' not in retries.allowed_methods  # NOTE: create_new_signal must never be sent twice
+
+    def test_connection_pools_fit_parallel_downloads(self):
+        api_service = APIService(self.access_token, parallel_downloads=50)
+
+        assert api_service._api_client.get_adapter('https://app.cardiomatics.com')._pool_maxsize >= 50
+        assert api_service._dl_client.get_adapter('https://storage.example.com')._pool_maxsize == 50
+
+    def test_create_new_signal_success(self, api_service, http_mocker):
+        response = api_service.create_new_signal('name', 'example.txt')
+
+        assert http_mocker.last_request.headers['Private-Token'] == self.access_token
+        assert response == {'signal_id': '123'}
 
     @pytest.mark.parametrize(
-        "status_code, exception",
+        "create_new_signal_mocker, exception",
+        [
+            (401, APIService.AccessDeniedError),
+            (403, NotImplementedError),
+            (500, NotImplementedError),
+        ],
+        indirect=['create_new_signal_mocker'],
+    )
+    def test_create_new_signal_failure(self, api_service, create_new_signal_mocker, exception):
+        with pytest.raises(exception):
+            api_service.create_new_signal('name', 'example.txt')
+
+        assert create_new_signal_mocker.last_request.headers['Private-Token'] == self.access_token
+
+    def test_request_printout_success(self, api_service, http_mocker):
+        response = api_service.request_printout(123)
+
+        assert http_mocker.last_request.headers['Private-Token'] == self.access_token
+
+        assert response == {'test': 'test'}
+
+    @pytest.mark.parametrize(
+        "printout_mocker, exception",
         [
             (401, APIService.AccessDeniedError),
             (403, APIService.NotVisitedBeforeViaPortalError),
             (500, NotImplementedError),
         ],
+        indirect=['printout_mocker'],
     )
-    def test_request_printout_failure(self, status_code, exception):
-        with requests_mock.Mocker() as m:
-            m.get(
-                'https://app.cardiomatics.com/api/v2/signals/123/report/printout',
-                status_code=status_code,
-                json={'test': 'test'},
-            )
+    def test_request_printout_failure(self, api_service, printout_mocker, exception):
+        with pytest.raises(exception):
+            api_service.request_printout(123)
 
-            with pytest.raises(exception):
-                self.api_service.request_printout(123)
+        assert printout_mocker.last_request.headers['Private-Token'] == self.access_token
 
-            assert m.last_request.headers['Private-Token'] == self.access_token
+    def test_upload_file_to_object_storage_does_not_send_token(self, api_service, http_mocker):
+        api_service.upload_file_to_object_storage(
+            self.storage_url, MockFileObject(b"file content", "signal_file.pdf"), {'key': 'value'}
+        )
 
-    def test_get_list_signals_page_success(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f'https://app.cardiomatics.com/api/v2/signals?page=1&per_page={self.api_service._PER_PAGE}&new=True',
-                status_code=200,
-                headers={'x-total-pages': '2'},
-                json=[{'id': 1}],
-            )
+        assert 'Private-Token' not in http_mocker.last_request.headers
 
-            last_page, response = self.api_service._get_signals_page(1, True)
+    def test_upload_file_to_object_storage_streams_multipart(self, api_service, http_mocker):
+        api_service.upload_file_to_object_storage(
+            self.storage_url, MockFileObject(b"file content", "signal_file.pdf"), {'key': 'value'}
+        )
 
-            assert last_page == 2
-            assert response == [{'id': 1}]
+        assert http_mocker.last_request.headers['Content-Type'].startswith('multipart/form-data')
+        body = http_mocker.last_request.body.read()
+        assert b'name="key"' in body
+        assert body.index(b'name="key"') < body.index(b'name="file"; filename="signal_file.pdf"')
+        assert b'file content' in body
 
-    def test_get_list_signals_page_failure(self):
-        with requests_mock.Mocker() as m:
-            m.get(
-                f'https://app.cardiomatics.com/api/v2/signals?page=1&per_page={self.api_service._PER_PAGE}&new=True',
-                status_code=401,
-            )
+    def test_upload_file_to_object_storage_stringifies_post_fields(self, api_service, http_mocker):
+        api_service.upload_file_to_object_storage(
+            self.storage_url, MockFileObject(b"file content", "signal_file.pdf"), {'key': 'value', 'expires': 3600}
+        )
 
-            with pytest.raises(APIService.AccessDeniedError):
-                self.api_service._get_signals_page(1, True)
+        body = http_mocker.last_request.body.read()
+        assert b'name="expires"\r\n\r\n3600\r\n' in body
 
-    def test_get_list_signals_batches(self):
-        self.api_service._PER_PAGE = 1
+    def test_upload_file_to_object_storage_sends_post_fields_before_file(self, api_service, http_mocker):
+        api_service.upload_file_to_object_storage(
+            self.storage_url,
+            MockFileObject(b"file content", "signal_file.pdf"),
+            {"file": "file_data", "file_name": "test_signal.pdf", "skipped": None},
+        )
 
-        with requests_mock.Mocker() as m:
-            first_response = [{'id': 1}]
-            m.get(
-                'https://app.cardiomatics.com/api/v2/signals?page=1&per_page=1',
-                status_code=200,
-                headers={'x-total-pages': '2'},  # NOTE: at this stage there are just 2 pages
-                json=first_response,
-            )
-            second_response = [{'id': 2}]
-            m.get(
-                'https://app.cardiomatics.com/api/v2/signals?page=2&per_page=1',
-                status_code=200,
-                headers={'x-total-pages': '3'},  # NOTE: someone added new entry in the meantime, now we have 3 pages
-                json=second_response,
-            )
-            third_response = [{'id': 3}]
-            m.get(
-                'https://app.cardiomatics.com/api/v2/signals?page=3&per_page=1',
-                status_code=200,
-                headers={'x-total-pages': '3'},
-                json=third_response,
-            )
+        body = http_mocker.last_request.body.read()
+        file_part = body.index(b'name="file"; filename="signal_file.pdf"')
+        assert body.index(b'name="file"\r\n\r\nfile_data\r\n') < file_part
+        assert body.index(b'name="file_name"\r\n\r\ntest_signal.pdf\r\n') < file_part
+        assert b'name="skipped"' not in body
+
+    def test_get_file_does_not_send_token(self, api_service, http_mocker):
+        response = api_service.get_file(f'{self.storage_url}/test_signal.pdf')
+
+        assert 'Private-Token' not in http_mocker.last_request.headers
+        assert http_mocker.last_request.headers['Accept-Encoding'] == 'identity'
+        assert response.content == b'pdf'
+
+    def test_get_list_signals_page_success(self, api_service, http_mocker):
+        last_page, response = api_service._get_signals_page(1, True)
 
-            responses = list(self.api_service.get_list_signals_batches())
+        assert http_mocker.last_request.qs == {
+            'page': ['1'],
+            'per_page': [str(api_service._PER_PAGE)],
+            'new': ['true'],
+        }
+        assert last_page == 2
+        assert response == [{'id': 1}]
+
+    @pytest.mark.parametrize(
+        "signals_page_mocker, exception",
+        [
+            (401, APIService.AccessDeniedError),
+            (500, NotImplementedError),
+        ],
+        indirect=['signals_page_mocker'],
+    )
+    def test_get_list_signals_page_failure(self, api_service, signals_page_mocker, exception):
+        with pytest.raises(exception):
+            api_service._get_signals_page(1, True)
+
+        assert signals_page_mocker.last_request.headers['Private-Token'] == self.access_token
+
+    def test_get_list_signals_batches(self, api_service, http_mocker, monkeypatch):
+        # NOTE: page 1 reports 2 pages, page 2 reports 3, someone added new entry in the meantime
+        monkeypatch.setattr(api_service, '_PER_PAGE', 1)
+
+        responses = list(api_service.get_list_signals_batches())
+
+        assert responses == [[{'id': 1}], [{'id': 2}], [{'id': 3}]]
+        # NOTE: successfully asked for all pages, including third one
+
+        assert http_mocker.call_count == 3
+
+    def test_get_list_signals_batches_stops_when_pages_shrink(self, api_service, http_mocker, monkeypatch):
+        monkeypatch.setattr(api_service, '_PER_PAGE', 1)
+
+        http_mocker.get(f'{self.signals_url}?page=1', status_code=200, headers={'x-total-pages': '3'}, json=[{'id': 1}])
+        http_mocker.get(
+            f'{self.signals_url}?page=2',
+            status_code=200,
+            headers={'x-total-pages': '2'},  # NOTE: someone removed an entry in the meantime
+            json=[{'id': 2}],
+        )
+        http_mocker.get(f'{self.signals_url}?page=3', status_code=404)
 
-            assert responses == [first_response, second_response, third_response]
-            # NOTE: successfully asked for all pages, including third one
+        responses = list(api_service.get_list_signals_batches())
 
-            assert m.call_count == 3
+        assert responses == [[{'id': 1}], [{'id': 2}]]
 
 
 if __name__ == '__main__':